@@ -139,15 +139,18 @@ async def process_content_async(content: WebpageContent):
         chunks = chunk_text(combined_text)
         logger.info(f"Created {len(chunks)} chunks from content")
         
-        # Process each chunk
-        for i, chunk in enumerate(chunks):
-            chunk_id = f"{document_id}-chunk-{i}"
-            
-            # Generate embeddings for this chunk
-            embeddings = await create_embeddings(
+        # Generate embeddings for all chunks concurrently so they are encoded in batches
+        chunk_embeddings = await asyncio.gather(*[
+            create_embeddings(
                 text=chunk,
                 metadata={}  # Empty metadata for embedding generation
             )
+            for chunk in chunks
+        ])
+        
+        # Process each chunk
+        for i, (chunk, embeddings) in enumerate(zip(chunks, chunk_embeddings)):
+            chunk_id = f"{document_id}-chunk-{i}"
             
             # Create enhanced metadata for the chunk
             metadata = {
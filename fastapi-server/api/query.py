@@ -1,18 +1,29 @@
 from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 import logging
-import math
+import numpy as np
 import asyncio
+import functools
+import hashlib
+import io
+import orjson
 import os
-from typing import Optional, List
+import time
+from typing import Optional, List, AsyncIterator, Union
 
 # Import vector database and embedding model
 from models.embedding_model import create_embeddings
+from models.rerank_model import rerank
+from api.response_sections import ResponseSectionTracker, parse_structured_response
+from db.vector_db import query_vector_db
+from db.semantic_cache import semantic_cache
 
 # Import instructor for structured output
 import instructor
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 import httpx
+import tiktoken
 
 logger = logging.getLogger(__name__)
 
@@ -46,10 +57,28 @@ GROQ_MODELS = {
 }
 DEFAULT_GROQ_MODEL = "llama3-8b-8192"
 
+# Readable model names, precomputed for response and error messages
+_GROQ_DISPLAY_NAMES = {model_id: info["name"] for model_id, info in GROQ_MODELS.items()}
+
+# Retrieval configuration: over-fetch candidates from the vector db, then keep
+# the best chunks according to the cross-encoder
+RETRIEVAL_LIMIT = 30
+RERANK_TOP_K = 3
+
+# Token budgeting: prompts are measured with a cl100k tokenizer (an approximation for
+# non-OpenAI models, hence the safety margin) against the model's context window
+LOCAL_CONTEXT_WINDOW = 4096  # Default LM-Studio context length
+TOKEN_SAFETY_MARGIN = 256
+TOKENIZER_RETRY_SECONDS = 60  # Wait before retrying a failed tokenizer load
+
+_tokenizer = None
+_tokenizer_retry_at = 0.0
+
 router = APIRouter(
     prefix="/query",
     tags=["query"],
     responses={404: {"description": "Not found"}},
+    default_response_class=ORJSONResponse,  # Faster serialization of large reasoning payloads
 )
 
 class QueryRequest(BaseModel):
@@ -57,6 +86,7 @@ class QueryRequest(BaseModel):
     llm_choice: str = "local"  # Default to local LLM
     model: Optional[str] = None  # Optional model selection for Groq
     api_key: Optional[str] = None  # Optional API key for remote LLMs
+    stream: bool = False  # Stream the response as server-sent events
 
 class QueryResponse(BaseModel):
     answer: str = Field(description="The final answer to the user's question")
@@ -69,26 +99,126 @@ class LLMStructuredResponse(BaseModel):
     reasoning: str = Field(description="Step-by-step reasoning based on the provided context")
     answer: str = Field(description="Concise final answer to the user's question")
 
-def cosine_similarity(a: list, b: list) -> float:
-    # Simple cosine similarity: dot(a,b)/(||a||*||b||)
-    dot_product = sum(x*y for x,y in zip(a, b))
-    norm_a = math.sqrt(sum(x*x for x in a))
-    norm_b = math.sqrt(sum(x*x for x in b))
-    if norm_a == 0 or norm_b == 0:
-        return 0.0
-    return dot_product / (norm_a * norm_b)
+def format_sse(event: str, data: dict) -> str:
+    """Format a server-sent event frame."""
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+async def stream_query_response(response: QueryResponse) -> AsyncIterator[str]:
+    """Stream an already complete response as a single terminating result frame."""
+    yield format_sse("result", response.dict())
+
+async def stream_llm_response(stream, source_urls: list, model_used: str, question_embedding, cache_key: tuple, cache_generation: int) -> AsyncIterator[str]:
+    """
+    Relay streamed LLM output as server-sent events.
+    
+    Emits a "reasoning" event once the answer marker appears, then "answer" events with text
+    deltas as tokens arrive (see ResponseSectionTracker), followed by a terminating "result"
+    event carrying the full QueryResponse (or an "error" event).
+    """
+    tracker = ResponseSectionTracker()
+    try:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                for section, text in tracker.feed(delta):
+                    yield format_sse(section, {"text": text})
+        for section, text in tracker.flush():
+            yield format_sse(section, {"text": text})
+    except Exception as e:
+        logger.error(f"Error streaming LLM response: {e}", exc_info=True)
+        yield format_sse("error", {"detail": f"LLM streaming failed. Error: {str(e)}"})
+        return
+    finally:
+        # Release the HTTP connection back to the shared pool, also when the client disconnects
+        await stream.close()
+    
+    reasoning, answer = tracker.sections()
+    response = QueryResponse(
+        answer=answer,
+        reasoning=reasoning,
+        source_urls=source_urls,
+        model_used=model_used
+    )
+    semantic_cache.store(question_embedding, cache_key, response, cache_generation)
+    yield format_sse("result", response.dict())
+
+# Shared HTTP/2 connection pool for all LLM clients (HTTP/2 is negotiated for https
+# endpoints such as Groq; the local LM-Studio server keeps using HTTP/1.1)
+http_client = DefaultAsyncHttpxClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=50)
+)
 
+# Clients are cached per (llm_choice, api_key) and share http_client, so connections are
+# reused across requests; rotated keys simply get a new entry (use
+# get_openai_client.cache_clear() to reset)
+@functools.lru_cache(maxsize=64)
 def get_openai_client(llm_choice: str, api_key: Optional[str] = None):
-    """Get appropriate OpenAI client based on LLM choice."""
+    """Get appropriate async OpenAI client based on LLM choice."""
     if llm_choice == "local":
-        return OpenAI(base_url=LM_STUDIO_URL, api_key=LM_STUDIO_API_KEY)
+        return AsyncOpenAI(base_url=LM_STUDIO_URL, api_key=LM_STUDIO_API_KEY, http_client=http_client)
     elif llm_choice == "groq":
         if not api_key:
             raise ValueError("A valid Groq API key is required to use Groq models")
-        return OpenAI(base_url=GROQ_API_URL, api_key=api_key)
+        return AsyncOpenAI(base_url=GROQ_API_URL, api_key=api_key, http_client=http_client)
     else:
         raise ValueError(f"Unsupported LLM choice: {llm_choice}")
 
+async def load_tokenizer():
+    """
+    Load the cl100k encoding if it is not loaded yet.
+    
+    The first load may download the BPE file, so it runs in a thread pool to avoid
+    blocking the event loop. A failed load (e.g. offline) is retried after
+    TOKENIZER_RETRY_SECONDS; until then tokens are estimated as chars/4.
+    """
+    global _tokenizer, _tokenizer_retry_at
+    if _tokenizer is not None or time.monotonic() < _tokenizer_retry_at:
+        return _tokenizer
+    
+    # Set before awaiting so concurrent requests don't start a second load
+    _tokenizer_retry_at = time.monotonic() + TOKENIZER_RETRY_SECONDS
+    loop = asyncio.get_event_loop()
+    try:
+        _tokenizer = await loop.run_in_executor(None, tiktoken.get_encoding, "cl100k_base")
+    except Exception as e:
+        logger.warning(f"Could not load tiktoken encoding, estimating tokens as chars/4: {e}")
+    return _tokenizer
+
+def count_tokens(text: str) -> int:
+    """Approximate number of LLM tokens in a piece of text."""
+    if _tokenizer is None:
+        return (len(text) + 3) // 4
+    return len(_tokenizer.encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text: str, max_count: int) -> str:
+    """Cut text down to roughly max_count LLM tokens."""
+    if _tokenizer is None:
+        return text[:max_count * 4]
+    return _tokenizer.decode(_tokenizer.encode(text, disallowed_special=())[:max_count])
+
+def build_structured_prompt(question: str, combined_context: str) -> str:
+    """Build the prompt asking the LLM for reasoning followed by an answer."""
+    return f"""Answer the question based only on the following context. If the context doesn't contain the answer, say "I don't have information about that in my knowledge base."
+
+Context:
+{combined_context}
+
+Question: {question}
+
+You MUST structure your response in exactly this format:
+1. First provide your step-by-step reasoning
+2. Then provide your final answer
+
+```
+Reasoning: [your detailed reasoning here]
+Answer: [your concise answer here]
+```
+Reasoning:
+"""
+
 def get_model_for_provider(llm_choice: str, model_id: Optional[str] = None):
     """Get appropriate model ID based on provider and user selection."""
     if llm_choice == "local":
@@ -104,28 +234,43 @@ def get_model_for_provider(llm_choice: str, model_id: Optional[str] = None):
     # Fallback
     return "deepseek-r1-distill-qwen-7b"
 
-async def query_llm(question: str, llm_choice: str = "local", model: Optional[str] = None, api_key: Optional[str] = None) -> QueryResponse:
+async def query_llm(question: str, llm_choice: str = "local", model: Optional[str] = None, api_key: Optional[str] = None, stream: bool = False) -> Union[QueryResponse, AsyncIterator[str]]:
+    """
+    Answer a question from the knowledge base.
+    
+    Returns a QueryResponse, or when `stream` is set and the LLM is called, an async
+    iterator of server-sent event frames (see stream_llm_response).
+    """
     logger.info(f"Processing query using {llm_choice} LLM with model {model or 'default'}: {question}")
     
     # Generate embedding for the query
     question_embedding = await create_embeddings(question, {})
     
-    # Use ChromaDB to find the most relevant documents
-    from db.vector_db import query_vector_db
+    # Get appropriate model based on provider and user selection
+    model_id = get_model_for_provider(llm_choice, model)
+    
+    # Return a cached response for a semantically equivalent question to the same model
+    # (keyed on a fingerprint of the API key, so a Groq hit needs the key that produced it)
+    api_key_fingerprint = hashlib.sha256(api_key.encode()).hexdigest() if api_key else None
+    cache_key = (llm_choice, model_id, api_key_fingerprint)
+    cache_generation = semantic_cache.generation
+    cached_response = semantic_cache.probe(question_embedding, cache_key)
+    if cached_response is not None:
+        return cached_response
     
-    # Retrieve top 3 most relevant chunks
-    relevant_chunks, similarities = await query_vector_db(
+    # Over-fetch candidate chunks from ChromaDB's HNSW index for reranking
+    chunk_texts, chunk_metadatas, similarities = await query_vector_db(
         query_embedding=question_embedding,
-        limit=3,  # Retrieve multiple chunks instead of just 1
+        limit=RETRIEVAL_LIMIT,
         threshold=0.1  # similarity threshold
     )
 
-    # logger.debug(f"YYYYY Found {len(relevant_chunks)} relevant chunks with similarities: {similarities}")
+    # logger.debug(f"YYYYY Found {len(chunk_texts)} relevant chunks with similarities: {similarities}")
     
     # If no document found or similarity is too low
-    if not relevant_chunks:
+    if not chunk_texts:
         logger.info("No sufficient context found in vector db.")
-        model_info = f"{GROQ_MODELS.get(model, {}).get('name', model)}" if llm_choice == "groq" and model else "Local LLM"
+        model_info = _GROQ_DISPLAY_NAMES.get(model, model) if llm_choice == "groq" and model else "Local LLM"
         return QueryResponse(
             answer="I don't have enough information to answer that question.",
             reasoning="No reasoning available due to lack of context.",
@@ -133,67 +278,105 @@ async def query_llm(question: str, llm_choice: str = "local", model: Optional[st
             model_used=model_info
         )
     
-    # Sort chunks by similarity (descending)
-    sorted_chunks = sorted(zip(relevant_chunks, similarities), key=lambda x: x[1], reverse=True)
+    # Rerank candidates with the cross-encoder and keep the top chunks (descending)
+    # (partial selection of the top k, then sort only those)
+    rerank_scores = await rerank(question, chunk_texts)
+    k = min(RERANK_TOP_K, len(rerank_scores))
+    top_indices = np.argpartition(-rerank_scores, k - 1)[:k]
+    top_indices = top_indices[np.argsort(-rerank_scores[top_indices])]
 
-    for idx, (_, sim) in enumerate(sorted_chunks, start=1):
-        logger.info(f"Chunk {idx} similarity score: {sim}")
+    for idx, i in enumerate(top_indices, start=1):
+        logger.info(f"Chunk {idx} rerank score: {rerank_scores[i]} (similarity: {similarities[i]})")
 
     
-    # Extract unique source URLs from all chunks
-    source_urls = []
-    for chunk, _ in sorted_chunks:
-        source_url = chunk["metadata"].get("source_url", "")
-        if source_url and source_url not in source_urls:
-            source_urls.append(source_url)
+    # Set context window and max tokens based on model
+    if llm_choice == "groq" and model_id in GROQ_MODELS:
+        context_window = GROQ_MODELS[model_id]["max_tokens"]
+        max_tokens = min(1500, context_window // 4)  # Use 1/4 of available context
+    else:
+        context_window = LOCAL_CONTEXT_WINDOW
+        max_tokens = 800  # Default for local models
     
-    # Combine chunks into a single context string, including information about their source
-    context_parts = []
-    for i, (chunk, similarity) in enumerate(sorted_chunks):
-        title = chunk["metadata"].get("title", "Untitled")
-        source_url = chunk["metadata"].get("source_url", "Unknown source")
-        context_parts.append(f"Source {i+1} - {title} ({source_url}):\n{chunk['text']}")
+    # Combine chunks into a single context string in one pass, including information about
+    # their source, and remember where each chunk ends so weak chunks can be cut off
+    buffer = io.StringIO()
+    chunk_ends = []
+    for rank, i in enumerate(top_indices):
+        if rank:
+            buffer.write("\n\n---\n\n")
+        buffer.write("Source ")
+        buffer.write(str(rank + 1))
+        buffer.write(" - ")
+        buffer.write(chunk_metadatas[i].get("title", "Untitled"))
+        buffer.write(" (")
+        buffer.write(chunk_metadatas[i].get("source_url", "Unknown source"))
+        buffer.write("):\n")
+        buffer.write(chunk_texts[i])
+        chunk_ends.append(buffer.tell())
+    combined_context = buffer.getvalue()
+    structured_prompt = build_structured_prompt(question, combined_context)
     
-    combined_context = "\n\n---\n\n".join(context_parts)
+    # Tokenize the prompt once, then drop the weakest chunks until it leaves room for the response
+    await load_tokenizer()
+    prompt_tokens = count_tokens(structured_prompt)
+    kept = len(chunk_ends)
+    while kept > 1 and prompt_tokens + max_tokens + TOKEN_SAFETY_MARGIN > context_window:
+        kept -= 1
+        prompt_tokens -= count_tokens(combined_context[chunk_ends[kept - 1]:chunk_ends[kept]])
+        logger.info(f"Dropped weakest chunk to fit the context window of {context_window} tokens")
+    if kept < len(chunk_ends):
+        top_indices = top_indices[:kept]
+        combined_context = combined_context[:chunk_ends[kept - 1]]
     
-    # Update prompt to ask for structured information without specifying format
-    structured_prompt = f"""Answer the question based only on the following context. If the context doesn't contain the answer, say "I don't have information about that in my knowledge base."
-
-Context:
-{combined_context}
-
-Question: {question}
-
-You MUST structure your response in exactly this format:
-1. First provide your step-by-step reasoning
-2. Then provide your final answer
-
-```
-Reasoning: [your detailed reasoning here]
-Answer: [your concise answer here]
-```
-Reasoning:
-"""
+    # If the best chunk alone is still too long, trim its text to fit
+    overflow = prompt_tokens + max_tokens + TOKEN_SAFETY_MARGIN - context_window
+    if overflow > 0:
+        chunk_text = chunk_texts[top_indices[0]]
+        chunk_tokens = count_tokens(chunk_text)
+        if overflow >= chunk_tokens:
+            raise ValueError(f"The question is too long for the {context_window} token context window of {model_id}")
+        trimmed_text = truncate_to_tokens(chunk_text, chunk_tokens - overflow)
+        combined_context = combined_context[:len(combined_context) - len(chunk_text)] + trimmed_text
+        prompt_tokens -= chunk_tokens - count_tokens(trimmed_text)
+        logger.info(f"Trimmed the remaining chunk by {overflow} tokens to fit the context window of {context_window} tokens")
+    
+    if kept < len(chunk_ends) or overflow > 0:
+        structured_prompt = build_structured_prompt(question, combined_context)
+    
+    # Extract unique source URLs from all chunks (dict keys dedupe while keeping rank order)
+    source_urls = list(dict.fromkeys(
+        chunk_metadatas[i]["source_url"]
+        for i in top_indices
+        if chunk_metadatas[i].get("source_url")
+    ))
 
     try:
         # Get appropriate client based on LLM choice
         base_client = get_openai_client(llm_choice, api_key)
         
-        # Get appropriate model based on provider and user selection
-        model_id = get_model_for_provider(llm_choice, model)
+        # Log model selection
+        logger.info(f"Using model: {model_id} with max_tokens: {max_tokens}")
         
-        # Set max tokens based on model
-        if llm_choice == "groq" and model_id in GROQ_MODELS:
-            max_tokens = min(1500, GROQ_MODELS[model_id]["max_tokens"] // 4)  # Use 1/4 of available context
+        # Get readable model name for the response
+        if llm_choice == "groq" and model_id in _GROQ_DISPLAY_NAMES:
+            model_used = _GROQ_DISPLAY_NAMES[model_id]
         else:
-            max_tokens = 800  # Default for local models
+            model_used = "Local LLM (LM-Studio)"
         
-        # Log model selection
-        logger.info(f"Using model: {model_id} with max_tokens: {max_tokens}")
+        if stream:
+            # Open the stream before responding so connection errors still surface as HTTP errors
+            llm_stream = await base_client.chat.completions.create(
+                model=model_id,
+                messages=[{"role": "user", "content": structured_prompt}],
+                temperature=0.7,
+                max_tokens=max_tokens,
+                stream=True
+            )
+            return stream_llm_response(llm_stream, source_urls, model_used, question_embedding, cache_key, cache_generation)
         
         try:
             # Use regular completion and parse the response manually
-            response = base_client.chat.completions.create(
+            response = await base_client.chat.completions.create(
                 model=model_id,
                 messages=[{"role": "user", "content": structured_prompt}],
                 temperature=0.7,
@@ -203,36 +386,23 @@ Reasoning:
             full_response = response.choices[0].message.content
             
             # Parse the response to extract reasoning and answer
-            reasoning = ""
-            answer = full_response
-            
-            # Try to extract reasoning and answer based on the format
-            if "Reasoning:" in full_response and "Answer:" in full_response:
-                parts = full_response.split("Answer:")
-                if len(parts) > 1:
-                    answer = parts[1].strip()
-                    reasoning_parts = parts[0].split("Reasoning:")
-                    if len(reasoning_parts) > 1:
-                        reasoning = reasoning_parts[1].strip()
+            reasoning, answer = parse_structured_response(full_response)
             
         except Exception as parse_error:
             logger.error(f"Error parsing structured response: {parse_error}. Using full response as answer.")
             # Fallback to using the full response as answer
             answer = full_response
             reasoning = "Unable to extract structured reasoning."
-        
-        # Get readable model name for the response
-        if llm_choice == "groq" and model_id in GROQ_MODELS:
-            model_used = GROQ_MODELS[model_id]["name"]
-        else:
-            model_used = "Local LLM (LM-Studio)"
             
-        return QueryResponse(
+        response = QueryResponse(
             answer=answer, 
             reasoning=reasoning,
             source_urls=source_urls,
             model_used=model_used
         )
+        # Skipped if documents were ingested while the LLM was answering
+        semantic_cache.store(question_embedding, cache_key, response, cache_generation)
+        return response
     
     except ValueError as ve:
         # Handle missing API keys or other validation errors
@@ -247,7 +417,7 @@ Reasoning:
         if llm_choice == "local":
             error_msg = f"Local LLM query failed. Is LM-Studio running at {LM_STUDIO_URL}? Error: {str(e)}"
         else:
-            model_name = GROQ_MODELS.get(model, {}).get("name", model) if model else "default"
+            model_name = _GROQ_DISPLAY_NAMES.get(model, model) if model else "default"
             error_msg = f"Groq API query with model {model_name} failed. Please check your API key and try again. Error: {str(e)}"
             
         raise HTTPException(status_code=500, detail=error_msg)
@@ -264,7 +434,13 @@ async def query_knowledge(query: QueryRequest):
             )
             
         logger.info(f"Received query using {query.llm_choice} LLM with model {query.model or 'default'}: {query.question}")
-        response = await query_llm(query.question, query.llm_choice, query.model, query.api_key)
+        response = await query_llm(query.question, query.llm_choice, query.model, query.api_key, query.stream)
+        
+        if query.stream:
+            # Cached and no-context responses are complete already; send them as a single frame
+            if isinstance(response, QueryResponse):
+                response = stream_query_response(response)
+            return StreamingResponse(response, media_type="text/event-stream")
         return response
     except ValueError as ve:
         # Convert ValueError to HTTPException with appropriate status code
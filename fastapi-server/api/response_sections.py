@@ -0,0 +1,96 @@
+"""
+Reasoning/answer parsing for SecondBrain LLM responses.
+Splits (streamed) LLM output into its reasoning and answer sections.
+"""
+
+# Markers introducing the reasoning and the answer sections in the LLM output
+REASONING_MARKER = "Reasoning:"
+ANSWER_MARKER = "Answer:"
+
+class ResponseSectionTracker:
+    """
+    Incrementally split streamed LLM output into reasoning and answer sections.
+    
+    The prompt already ends with the reasoning marker, so everything before the first
+    answer marker is reasoning (a repeated leading reasoning marker is skipped) and
+    everything after it is the answer. Reasoning is held back until an answer marker
+    confirms it; output that never contains one (e.g. a reply cut off by max_tokens)
+    is emitted as the answer when the stream is flushed.
+    """
+    
+    def __init__(self):
+        self.text = ""
+        self.section = "reasoning"
+        self._reasoning_start = None  # Known once a leading reasoning marker is ruled in or out
+        self._answer_idx = -1
+        self._scan_from = 0
+        self._emitted = 0
+    
+    def _locate_reasoning_start(self) -> bool:
+        """Skip a leading reasoning marker; returns False while the buffer could still be one."""
+        lead = len(self.text) - len(self.text.lstrip())
+        head = self.text[lead:]
+        if head.startswith(REASONING_MARKER):
+            self._reasoning_start = lead + len(REASONING_MARKER)
+        elif REASONING_MARKER.startswith(head):
+            return False
+        else:
+            self._reasoning_start = 0
+        self._scan_from = self._emitted = self._reasoning_start
+        return True
+    
+    def feed(self, delta: str) -> list:
+        """Add a chunk of output and return the (section, text) pieces that can be emitted."""
+        self.text += delta
+        pieces = []
+        
+        if self._reasoning_start is None and not self._locate_reasoning_start():
+            return pieces
+        
+        if self.section == "reasoning":
+            marker_idx = self.text.find(ANSWER_MARKER, self._scan_from)
+            if marker_idx == -1:
+                # Keep holding; only rescan a possible partial marker at the end of the buffer
+                self._scan_from = max(self._scan_from, len(self.text) - (len(ANSWER_MARKER) - 1))
+                return pieces
+            
+            if marker_idx > self._emitted:
+                pieces.append(("reasoning", self.text[self._emitted:marker_idx]))
+            self.section = "answer"
+            self._answer_idx = marker_idx
+            self._emitted = marker_idx + len(ANSWER_MARKER)
+        
+        if len(self.text) > self._emitted:
+            pieces.append(("answer", self.text[self._emitted:]))
+            self._emitted = len(self.text)
+        return pieces
+    
+    def flush(self) -> list:
+        """Return whatever output is still buffered once the stream has ended."""
+        if self._reasoning_start is None:
+            # The whole output was a (partial) reasoning marker or whitespace
+            self._reasoning_start = 0
+        
+        # Without an answer marker the held-back text is the answer
+        self.section = "answer"
+        pieces = []
+        if len(self.text) > self._emitted:
+            pieces.append(("answer", self.text[self._emitted:]))
+            self._emitted = len(self.text)
+        return pieces
+    
+    def sections(self) -> tuple:
+        """Return (reasoning, answer), split at the same offsets as the emitted pieces."""
+        reasoning_start = self._reasoning_start or 0
+        if self._answer_idx == -1:
+            return "", self.text[reasoning_start:].strip()
+        reasoning = self.text[reasoning_start:self._answer_idx].strip()
+        answer = self.text[self._answer_idx + len(ANSWER_MARKER):].strip()
+        return reasoning, answer
+
+def parse_structured_response(full_response: str) -> tuple:
+    """Split an LLM response into (reasoning, answer) with the same rule used for streaming."""
+    tracker = ResponseSectionTracker()
+    tracker.feed(full_response)
+    tracker.flush()
+    return tracker.sections()
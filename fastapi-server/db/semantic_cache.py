@@ -0,0 +1,111 @@
+import logging
+from typing import Any, Hashable, Optional
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+def cosine_batch(query: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+    """Score a unit-normalized query against each row of a matrix of unit vectors in one BLAS call."""
+    return matrix @ query
+
+class SemanticCache:
+    """
+    Semantic cache of query responses keyed on unit-normalized query embeddings.
+    
+    Embeddings are hashed into buckets with random-projection LSH (the sign of the
+    embedding projected onto random hyperplanes). A probe looks at the query's bucket
+    and its immediate neighbours (one flipped bit) and returns a cached value whose
+    embedding has cosine similarity of at least `threshold` with the query.
+    
+    Cached embeddings live in one contiguous float32 matrix used as a ring buffer, so
+    all candidates of a probe are scored together with cosine_batch.
+    
+    `generation` is incremented by every clear(). Callers capture it before computing a
+    value and pass it to store(), so a value computed before an invalidation is dropped.
+    """
+    
+    def __init__(self, num_planes: int = 16, threshold: float = 0.97, max_entries: int = 1024, seed: int = 0):
+        self.num_planes = num_planes
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.seed = seed
+        self._planes = None  # Created on first use, once the embedding dimension is known
+        self._powers = 1 << np.arange(num_planes, dtype=np.int64)
+        self._embeddings = None  # (max_entries, dim) float32, allocated with the planes
+        self._keys = [None] * max_entries
+        self._values = [None] * max_entries
+        self._slot_buckets = [None] * max_entries
+        self._buckets = {}  # Bucket -> list of slots
+        self._next_slot = 0
+        self.generation = 0
+    
+    def _bucket(self, embedding: np.ndarray) -> int:
+        if self._planes is None:
+            rng = np.random.default_rng(self.seed)
+            self._planes = rng.standard_normal((self.num_planes, embedding.shape[0])).astype(np.float32)
+            self._embeddings = np.zeros((self.max_entries, embedding.shape[0]), dtype=np.float32)
+        bits = (self._planes @ embedding) > 0
+        return int(self._powers[bits].sum())
+    
+    def probe(self, embedding, key: Hashable) -> Optional[Any]:
+        """Return the cached value for a semantically equivalent query with the same key, if any."""
+        embedding = np.asarray(embedding, dtype=np.float32)
+        bucket = self._bucket(embedding)
+        
+        slots = [
+            slot
+            for candidate in [bucket] + [bucket ^ (1 << i) for i in range(self.num_planes)]
+            for slot in self._buckets.get(candidate, ())
+            if self._keys[slot] == key
+        ]
+        if not slots:
+            return None
+        
+        similarities = cosine_batch(embedding, self._embeddings[slots])
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        
+        logger.info(f"Semantic cache hit with similarity {similarities[best]}")
+        return self._values[slots[best]]
+    
+    def store(self, embedding, key: Hashable, value: Any, generation: Optional[int] = None):
+        """
+        Cache a value for a query embedding, overwriting the oldest entry when full.
+        
+        If `generation` is given and the cache has been cleared since, the value is stale
+        and is not stored.
+        """
+        if generation is not None and generation != self.generation:
+            logger.info("Skipping semantic cache store for a response computed before invalidation")
+            return
+        
+        embedding = np.asarray(embedding, dtype=np.float32)
+        bucket = self._bucket(embedding)
+        
+        slot = self._next_slot
+        old_bucket = self._slot_buckets[slot]
+        if old_bucket is not None:
+            entries = self._buckets[old_bucket]
+            entries.remove(slot)
+            if not entries:
+                del self._buckets[old_bucket]
+        
+        self._embeddings[slot] = embedding
+        self._keys[slot] = key
+        self._values[slot] = value
+        self._slot_buckets[slot] = bucket
+        self._buckets.setdefault(bucket, []).append(slot)
+        self._next_slot = (slot + 1) % self.max_entries
+    
+    def clear(self):
+        """Drop all cached entries (e.g. when the underlying documents change)."""
+        self._buckets.clear()
+        self._keys = [None] * self.max_entries
+        self._values = [None] * self.max_entries
+        self._slot_buckets = [None] * self.max_entries
+        self._next_slot = 0
+        self.generation += 1
+
+# Shared cache for /query responses; invalidated on every vector db write
+semantic_cache = SemanticCache()
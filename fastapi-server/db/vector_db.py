@@ -1,23 +1,74 @@
 import uuid
 import asyncio
+import functools
 import logging
+import numpy as np
 import chromadb
 from chromadb.config import Settings
 import os
+from db.semantic_cache import semantic_cache
 
 logger = logging.getLogger(__name__)
 
 # Initialize ChromaDB client
 client = chromadb.PersistentClient(path="./vector_store")
 
+# HNSW index parameters for the collection. Chroma builds the index with hnswlib,
+# persists it under ./vector_store and reloads it on startup. Note that these
+# settings only apply when the collection is first created.
+HNSW_CONFIG = {
+    # Embeddings are unit-normalized by create_embeddings, so inner product equals
+    # cosine similarity (see distances_to_similarities)
+    "hnsw:space": "ip",
+    "hnsw:M": 16,
+    "hnsw:construction_ef": 64,
+    "hnsw:search_ef": 100,
+}
+
 # Create or get the collection for our documents
 try:
-    collection = client.get_or_create_collection(name="secondbrain_documents")
+    collection = client.get_or_create_collection(
+        name="secondbrain_documents",
+        metadata=HNSW_CONFIG
+    )
     logger.info(f"ChromaDB collection initialized with {collection.count()} documents")
 except Exception as e:
     logger.error(f"Error initializing ChromaDB: {e}")
     raise
 
+def get_collection_space(collection) -> str:
+    """Get the distance space the collection was actually created with (Chroma defaults to l2)."""
+    metadata = collection.metadata or {}
+    if metadata.get("hnsw:space"):
+        return metadata["hnsw:space"]
+    configuration = getattr(collection, "configuration", None)
+    if isinstance(configuration, dict):
+        hnsw = configuration.get("hnsw") or {}
+        if hnsw.get("space"):
+            return hnsw["space"]
+    return "l2"
+
+# Collections created before HNSW_CONFIG existed keep their original space
+COLLECTION_SPACE = get_collection_space(collection)
+if COLLECTION_SPACE != HNSW_CONFIG["hnsw:space"]:
+    logger.warning(
+        f"ChromaDB collection uses the '{COLLECTION_SPACE}' distance space instead of "
+        f"'{HNSW_CONFIG['hnsw:space']}'; similarities are converted accordingly. Delete "
+        f"./vector_store and re-ingest your pages to rebuild it with the current settings."
+    )
+
+def distances_to_similarities(distances: list) -> np.ndarray:
+    """
+    Convert Chroma distances to cosine similarities for the collection's distance space.
+    
+    Stored embeddings are unit vectors, so for "ip" and "cosine" the similarity is
+    1 - distance, and for "l2" (squared euclidean, 2 - 2 * cosine) it is 1 - distance / 2.
+    """
+    distances = np.asarray(distances, dtype=np.float32)
+    if COLLECTION_SPACE == "l2":
+        return 1.0 - distances / 2.0
+    return 1.0 - distances
+
 async def add_to_vector_db(text: str, embeddings: list, metadata: dict) -> str:
     """Add content to ChromaDB with embeddings and metadata"""
     document_id = str(uuid.uuid4())
@@ -30,6 +81,9 @@ async def add_to_vector_db(text: str, embeddings: list, metadata: dict) -> str:
             metadatas=[metadata]
         )
         logger.info(f"Added document {document_id} to ChromaDB")
+        
+        # Cached answers may no longer reflect the knowledge base
+        semantic_cache.clear()
         return document_id
     except Exception as e:
         logger.error(f"Error adding to ChromaDB: {e}")
@@ -45,47 +99,37 @@ async def query_vector_db(query_embedding: list, limit: int = 3, threshold: floa
         threshold: Minimum similarity threshold
         
     Returns:
-        Tuple of (list of documents, list of similarity scores)
+        Tuple of parallel arrays (list of texts, list of metadata dicts,
+        float32 array of similarity scores); all empty if nothing matched
     """
     try:
-        results = collection.query(
+        # Run the blocking index search in a thread pool so the event loop stays free
+        loop = asyncio.get_event_loop()
+        results = await loop.run_in_executor(None, functools.partial(
+            collection.query,
             query_embeddings=[query_embedding],
             n_results=limit,
             include=["documents", "metadatas", "distances"]
-        )
+        ))
         
         # Check if we have any results
         if not results["ids"] or not results["ids"][0]:
             logger.info("No results found in vector database")
-            return None, 0
+            return [], [], np.empty(0, dtype=np.float32)
         
-        # Process all returned results
-        docs = []
-        similarities = []
+        # Convert distances to similarity scores in one vectorized pass
+        # and keep only results above threshold
+        all_similarities = distances_to_similarities(results["distances"][0])
+        keep = np.flatnonzero(all_similarities >= threshold)
         
-        for i in range(len(results["documents"][0])):
-            # Convert distance to similarity score (1 - distance for cosine distance)
-            similarity = 1 - results["distances"][0][i]
-            
-            # Only include results above threshold
-            if similarity >= threshold:
-                doc_id = results["ids"][0][i]
-                text = results["documents"][0][i]
-                metadata = results["metadatas"][0][i]
-                
-                docs.append({
-                    "id": doc_id,
-                    "text": text,
-                    "metadata": metadata,
-                    "similarity": similarity
-                })
-                similarities.append(similarity)
-        
-        if not docs:
+        if keep.size == 0:
             logger.info(f"No documents found with similarity above threshold {threshold}")
-            return None, 0
-            
-        return docs, similarities
+            return [], [], np.empty(0, dtype=np.float32)
+        
+        # Return the results that passed the threshold as parallel arrays
+        texts = [results["documents"][0][i] for i in keep]
+        metadatas = [results["metadatas"][0][i] for i in keep]
+        return texts, metadatas, all_similarities[keep]
         
     except Exception as e:
         logger.error(f"Error querying ChromaDB: {e}")
@@ -1,11 +1,61 @@
 from sentence_transformers import SentenceTransformer
 import asyncio
+import functools
+from typing import Optional
 
 # Initialize the Sentence Transformer for MVP; model can be made configurable later.
 model = SentenceTransformer('all-MiniLM-L6-v2')
 
+# Embeddings are normalized to unit length so cosine similarity reduces to a dot product.
+encode = functools.partial(model.encode, normalize_embeddings=True)
+
+# Dynamic batching: embedding requests arriving within BATCH_TIMEOUT seconds of each
+# other are coalesced into a single model.encode call of up to MAX_BATCH_SIZE texts.
+MAX_BATCH_SIZE = 32
+BATCH_TIMEOUT = 0.005
+
+_queue: Optional[asyncio.Queue] = None
+_worker: Optional[asyncio.Task] = None
+
+async def _batch_worker(queue: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    while True:
+        # Wait for the first request, then give concurrent requests a short window to join
+        batch = [await queue.get()]
+        await asyncio.sleep(BATCH_TIMEOUT)
+        while len(batch) < MAX_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+        
+        texts = [text for text, _ in batch]
+        try:
+            # Run the compute-bound model.encode in a thread pool to avoid blocking event loop.
+            embeddings = await loop.run_in_executor(None, encode, texts)
+        except Exception:
+            # Encode each text on its own so only the failing requests get the exception
+            for text, future in batch:
+                try:
+                    embedding = await loop.run_in_executor(None, encode, [text])
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(embedding[0])
+            continue
+        
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+
 async def create_embeddings(text: str, metadata: dict) -> list:
-    # Run the compute-bound model.encode in a thread pool to avoid blocking event loop.
-    loop = asyncio.get_event_loop()
-    embeddings = await loop.run_in_executor(None, model.encode, text)
-    return embeddings
\ No newline at end of file
+    global _queue, _worker
+    
+    # Start the batching worker on first use (or if it has stopped)
+    if _worker is None or _worker.done():
+        _queue = asyncio.Queue()
+        _worker = asyncio.create_task(_batch_worker(_queue))
+    
+    future = asyncio.get_running_loop().create_future()
+    await _queue.put((text, future))
+    embeddings = await future
+    return embeddings
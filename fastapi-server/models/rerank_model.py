@@ -0,0 +1,14 @@
+from sentence_transformers import CrossEncoder
+import asyncio
+import numpy as np
+
+# Initialize the cross-encoder used to rerank retrieved chunks; loaded once at import.
+model = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2')
+
+async def rerank(query: str, texts: list) -> np.ndarray:
+    # Score every (query, text) pair; higher scores mean more relevant.
+    # Run the compute-bound model.predict in a thread pool to avoid blocking event loop.
+    loop = asyncio.get_event_loop()
+    pairs = [(query, text) for text in texts]
+    scores = await loop.run_in_executor(None, model.predict, pairs)
+    return np.asarray(scores, dtype=np.float32)
@@ -23,7 +23,7 @@ from fastapi.responses import RedirectResponse
 # Import API routes - need to adjust the path for imports to work from root directory
 sys.path.append(os.path.join(os.path.dirname(__file__), 'fastapi-server'))
 from api.ingest import router as ingest_router
-from api.query import router as query_router
+from api.query import router as query_router, load_tokenizer
 from api.status import router as status_router
 
 # Set up logging
@@ -179,6 +179,9 @@ async def startup_event():
     """Initialize components on application startup."""
     logger.info("Starting SecondBrain API")
     
+    # Load the tokenizer used for prompt token budgeting (may download it on first run)
+    await load_tokenizer()
+    
     # Start Streamlit server
     start_streamlit_server()
     
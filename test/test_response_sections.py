@@ -0,0 +1,56 @@
+"""
+Tests for splitting LLM output into reasoning and answer sections.
+Run from the project root with: python -m unittest discover -s test
+"""
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'fastapi-server'))
+from api.response_sections import ResponseSectionTracker, parse_structured_response
+
+CASES = {
+    "step1\nAnswer: bar": ("step1", "bar"),
+    "Reasoning: because A.\nAnswer: 42": ("because A.", "42"),
+    "  Reasoning: r Answer: a Answer: b": ("r", "a Answer: b"),
+    "Answer: x\nReasoning: y": ("", "x\nReasoning: y"),
+    "no markers at all": ("", "no markers at all"),
+    "Reasoning: only reasoning": ("", "only reasoning"),
+    "Reas": ("", "Reas"),
+    "": ("", ""),
+}
+
+def stream(text: str, rng: random.Random) -> tuple:
+    """Feed text to a tracker in random chunks; return (streamed sections, tracker)."""
+    tracker = ResponseSectionTracker()
+    pieces = []
+    i = 0
+    while i < len(text):
+        j = i + rng.randint(1, 4)
+        pieces += tracker.feed(text[i:j])
+        i = j
+    pieces += tracker.flush()
+    reasoning = "".join(piece for section, piece in pieces if section == "reasoning")
+    answer = "".join(piece for section, piece in pieces if section == "answer")
+    return (reasoning.strip(), answer.strip()), tracker
+
+class ParseStructuredResponseTest(unittest.TestCase):
+    def test_cases(self):
+        for text, expected in CASES.items():
+            with self.subTest(text=text):
+                self.assertEqual(parse_structured_response(text), expected)
+
+class ResponseSectionTrackerTest(unittest.TestCase):
+    def test_split_chunks_match_final_sections(self):
+        rng = random.Random(0)
+        for text, expected in CASES.items():
+            for _ in range(50):
+                with self.subTest(text=text):
+                    streamed, tracker = stream(text, rng)
+                    self.assertEqual(streamed, expected)
+                    self.assertEqual(tracker.sections(), expected)
+
+if __name__ == "__main__":
+    unittest.main()